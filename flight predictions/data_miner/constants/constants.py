@@ -3,6 +3,8 @@ HOURLY = "hourly"
 SUB_HOURLY = "sub_hourly"
 FORECAST = "forecast"
 TRACKER_FOLDER = "tracker"
+CSV_WRITE_BUFFER_SIZE = 1024 * 1024
+ZSTD_COMPRESSION_LEVEL = 3
 
 MODES = {
   HOURLY: {
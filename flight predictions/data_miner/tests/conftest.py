@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The miner imports its modules relative to the data_miner folder, as app.py does
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,193 @@
+import asyncio
+import csv
+import json
+import os
+from datetime import datetime, timedelta
+
+import httpx
+import pytest
+
+from weather_data_miner import WeatherDataMiner
+
+TRACKER = 'tracker/data_tracker_hourly.json'
+OUTPUT = 'data/JFK_weather_data_hourly.csv'
+
+
+@pytest.fixture
+def mock_api(tmp_path, monkeypatch):
+    """Runs the miner in a scratch folder against a mocked Weatherbit API and records every request."""
+    monkeypatch.chdir(tmp_path)
+    os.mkdir('data')
+    os.mkdir('tracker')
+    calls = []
+    waits = []
+    state = {'handler': None}
+
+    def transport_handler(request):
+        calls.append(dict(request.url.params))
+        return state['handler'](request.url.params)
+
+    async_client = httpx.AsyncClient
+    monkeypatch.setattr(httpx, 'AsyncClient', lambda *args, **kwargs: async_client(*args, transport=httpx.MockTransport(transport_handler), **kwargs))
+    # Record each back-off instead of sleeping through it
+    monkeypatch.setattr(WeatherDataMiner, 'get_backoff_delay', lambda self, attempt: waits.append(attempt) or 0)
+
+    def make_miner(handler, **env):
+        """Configures a miner for JFK with the given response handler; 21 days of history split into 7 day windows by default."""
+        settings = {
+            'BASE_URL': 'https://api.test/v2.0',
+            'API_KEYS': 'k1,k2',
+            'MODE': 'hourly',
+            'OLDEST_DATE': (datetime.utcnow() - timedelta(days=21)).date().isoformat(),
+            'DAYS_PER_REQUEST': '7',
+            'SAVE_CHECKPOINT_MONTHS': '100',
+            'MAX_RETRIES': '3',
+            'RETRY_DELAY_SECONDS': '0',
+            'KEY_COOLDOWN_SECONDS': '0',
+            'LOCATIONS': json.dumps([{'name': 'JFK', 'lat': 40.64, 'lon': -73.78}]),
+        }
+        settings.update(env)
+        for name, value in settings.items():
+            monkeypatch.setenv(name, value)
+        state['handler'] = handler
+        return WeatherDataMiner()
+
+    def run(handler, **env):
+        """Mines JFK once with the given response handler."""
+        make_miner(handler, **env).run()
+
+    run.make_miner = make_miner
+    run.calls = calls
+    run.waits = waits
+    return run
+
+
+def ok(params):
+    return httpx.Response(200, json={'data': [{'timestamp_local': params.get('start_date'), 'temp': 20, 'weather': {'icon': 'c01d'}}]})
+
+
+def rate_limited(params, retry_after='0'):
+    return httpx.Response(429, headers={'Retry-After': retry_after})
+
+
+def read_rows():
+    with open(OUTPUT, newline='') as file:
+        return list(csv.DictReader(file))
+
+
+def read_tracker():
+    if not os.path.exists(TRACKER):
+        return {}
+    with open(TRACKER) as file:
+        return json.load(file)
+
+
+def test_rotates_to_next_key_on_rate_limit(mock_api):
+    mock_api(lambda params: rate_limited(params) if params['key'] == 'k1' else ok(params))
+
+    assert len(read_rows()) == 4
+    assert mock_api.waits == []
+    assert read_tracker()['JFK'] == datetime.utcnow().date().isoformat()
+
+
+def test_waits_once_every_key_is_rate_limited(mock_api):
+    responses = [rate_limited, rate_limited, ok]
+    mock_api(lambda params: responses.pop(0)(params), DAYS_PER_REQUEST='60')
+
+    assert [call['key'] for call in mock_api.calls] == ['k1', 'k2', 'k1']
+    assert len(mock_api.waits) == 1
+    assert len(read_rows()) == 1
+
+
+def test_gives_up_after_max_retries(mock_api):
+    mock_api(rate_limited, DAYS_PER_REQUEST='60')
+
+    # Three full rotations over both keys, waiting between them
+    assert len(mock_api.calls) == 6
+    assert len(mock_api.waits) == 2
+    assert 'JFK' not in read_tracker()
+
+
+def test_gives_up_when_retry_after_exceeds_max_delay(mock_api):
+    mock_api(lambda params: rate_limited(params, retry_after='7200'), DAYS_PER_REQUEST='60', MAX_RETRY_DELAY_SECONDS='60')
+
+    assert len(mock_api.calls) == 2
+    assert mock_api.waits == []
+
+
+def test_resumes_after_failed_window_without_duplicates(mock_api):
+    oldest_date = datetime.utcnow().date() - timedelta(days=21)
+    failing_window = (oldest_date + timedelta(days=14)).isoformat()
+
+    mock_api(lambda params: httpx.Response(500) if params['start_date'] == failing_window else ok(params))
+    assert len(read_rows()) == 2
+    assert read_tracker()['JFK'] == failing_window
+
+    mock_api(ok)
+    timestamps = [row['timestamp_local'] for row in read_rows()]
+    assert len(timestamps) == 4
+    assert len(set(timestamps)) == 4
+
+
+def test_resumes_after_cancelled_run_without_duplicates(mock_api):
+    oldest_date = datetime.utcnow().date() - timedelta(days=21)
+    stalled_window = (oldest_date + timedelta(days=14)).isoformat()
+
+    async def stall_third_window(params):
+        if params['start_date'] == stalled_window:
+            await asyncio.Event().wait()
+        return ok(params)
+
+    async def cancel_once_stalled(miner):
+        # Cancel the run the way Ctrl-C does, while the third window is still in flight
+        task = asyncio.ensure_future(miner.mine_all_locations())
+        while len(mock_api.calls) < 4:
+            await asyncio.sleep(0.01)
+        # Give the two completed windows time to be written
+        await asyncio.sleep(0.05)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    asyncio.run(cancel_once_stalled(mock_api.make_miner(stall_third_window)))
+    assert len(read_rows()) == 2
+    assert read_tracker()['JFK'] == stalled_window
+
+    mock_api(ok)
+    timestamps = [row['timestamp_local'] for row in read_rows()]
+    assert len(timestamps) == 4
+    assert len(set(timestamps)) == 4
+
+
+def test_forecast_windows_share_one_request(mock_api):
+    async def slow_ok(params):
+        # Keep the first request in flight while the other windows look up the cache
+        await asyncio.sleep(0.05)
+        return ok(params)
+
+    mock_api(slow_ok, MODE='forecast')
+
+    assert len(mock_api.calls) == 1
+    with open('data/JFK_weather_data_forecast.csv', newline='') as file:
+        assert len(list(csv.DictReader(file))) == 4
+
+
+def test_forecast_cache_survives_repeated_runs(mock_api):
+    async def slow_ok(params):
+        await asyncio.sleep(0.01)
+        return ok(params)
+
+    # An expired cache makes the windows contend for the lock again on the second run
+    miner = mock_api.make_miner(slow_ok, MODE='forecast', FORECAST_CACHE_TTL_SECONDS='0')
+    miner.run()
+    miner.run()
+
+    assert len(mock_api.calls) == 8
+    with open('data/JFK_weather_data_forecast.csv', newline='') as file:
+        assert len(list(csv.DictReader(file))) == 8
+
+
+def test_failed_run_leaves_no_empty_compressed_segment(mock_api):
+    mock_api(lambda params: httpx.Response(500), COMPRESS_OUTPUT='true')
+
+    assert os.listdir('data') == []
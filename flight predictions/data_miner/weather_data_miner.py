@@ -1,15 +1,36 @@
-import requests
+import asyncio
+import httpx
+import io
+import itertools
+import zstandard
 import csv
+from collections import deque, namedtuple
 from datetime import datetime, timedelta
 import os
-import json
+import orjson
 import logging
+import random
+import re
 import time
-from constants.constants import HOURLY, MODES, OUTPUT_DATA_FOLDER, FORECAST
+from constants.constants import HOURLY, MODES, OUTPUT_DATA_FOLDER, FORECAST, CSV_WRITE_BUFFER_SIZE, ZSTD_COMPRESSION_LEVEL
 
 # Configure logging
 logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %(message)s')
 
+# A configured location; attribute access avoids a dict lookup per field
+Location = namedtuple('Location', 'name lat lon')
+
+class ApiKeyPartition:
+    """A subset of the API keys, rotated independently for the locations assigned to it."""
+
+    def __init__(self, api_keys, requests_per_key):
+        """
+        Initializes the partition with its keys and a request limit sized to them.
+        """
+        self.api_keys = api_keys
+        self.key_cursor = 0
+        self.request_semaphore = asyncio.Semaphore(len(api_keys) * requests_per_key)
+
 class WeatherDataMiner:
     """A class to miner weather data from the Weatherbit API and save it to CSV files."""
 
@@ -22,168 +43,314 @@ class WeatherDataMiner:
         self.mode = os.getenv('MODE', HOURLY).lower()
         if self.mode not in MODES.keys():
             raise Exception(f"Invalid mode selected. Select a valid mode. ({MODES.keys()})")
-        self.current_key_index = 0
-        self.oldest_date = datetime.strptime(os.getenv('OLDEST_DATE'), '%Y-%m-%d')
+        self.key_cooldowns = {}
+        self.oldest_date = datetime.fromisoformat(os.getenv('OLDEST_DATE'))
+        self.oldest_date_str = self.oldest_date.date().isoformat()
         self.days_per_request = int(os.getenv('DAYS_PER_REQUEST', 28))
         self.save_checkpoint_months = int(os.getenv('SAVE_CHECKPOINT_MONTHS', 6))
+        self.max_buffered_rows = int(os.getenv('MAX_BUFFERED_ROWS', 10000))
+        self.compress_output = os.getenv('COMPRESS_OUTPUT', 'false').lower() == 'true'
         self.max_retries = int(os.getenv('MAX_RETRIES', 3))
         self.retry_delay_seconds = int(os.getenv('RETRY_DELAY_SECONDS', 5))
-        self.locations = json.loads(os.getenv('LOCATIONS'))
-        self.api_key = self.get_api_key()
+        self.max_retry_delay_seconds = int(os.getenv('MAX_RETRY_DELAY_SECONDS', 60))
+        self.key_cooldown_seconds = int(os.getenv('KEY_COOLDOWN_SECONDS', self.retry_delay_seconds))
+        self.locations = [Location(location['name'], location['lat'], location['lon']) for location in orjson.loads(os.getenv('LOCATIONS'))]
         self.date_tracking = self.load_date_tracking()
+        self.last_saved_tracking = dict(self.date_tracking)
         self.forecast_hours = int(os.getenv('FORECAST_HOURS', 240))
+        self.url_template = self.get_url_template()
+        self.requests_per_key = int(os.getenv('REQUESTS_PER_KEY', 4))
+        self.request_timeout_seconds = int(os.getenv('REQUEST_TIMEOUT_SECONDS', 30))
+        self.forecast_cache_ttl_seconds = int(os.getenv('FORECAST_CACHE_TTL_SECONDS', self.forecast_hours * 3600 // 4))
+        self.response_cache = {}
+        self.cache_locks = {}
+        self.schema_cache = {}
+        self.client = None
 
     def run(self):
         """Runs the data mining process for all configured locations."""
-        for location in self.locations:
-            try:
-                self.mine_location(location)
+        asyncio.run(self.mine_all_locations())
+
+    async def mine_all_locations(self):
+        """Mines all locations concurrently, sharing one HTTP client and connection pool."""
+        # Split the keys and locations round-robin so every key is in use at once
+        partition_count = min(len(self.api_keys), len(self.locations))
+        partitions = [ApiKeyPartition(self.api_keys[i::partition_count], self.requests_per_key) for i in range(partition_count)]
+        # Locks are bound to the event loop that first waits on them, so each run needs its own;
+        # the responses they guard stay cached across runs
+        self.cache_locks = {}
+        # Keep every pooled connection alive across the longest retry wait (backoff is capped at
+        # max_retry_delay_seconds plus under a second of jitter) so later windows reuse the TLS session
+        limits = httpx.Limits(max_connections=32, max_keepalive_connections=32, keepalive_expiry=self.max_retry_delay_seconds + 1)
+        async with httpx.AsyncClient(http2=True, limits=limits, timeout=self.request_timeout_seconds) as client:
+            self.client = client
+            results = await asyncio.gather(
+                *[self.mine_location(location, partitions[i % partition_count]) for i, location in enumerate(self.locations)],
+                return_exceptions=True
+            )
+        self.client = None
+        for location, result in zip(self.locations, results):
+            if isinstance(result, Exception):
+                logging.error(f'An error occurred while processing location {location.name}: {result}')
+            else:
                 logging.info(f'All data collection completed for {location}.')
-            except Exception as e:
-                logging.error(f'An error occurred while processing location {location["name"]}: {e}')
-                break
-
-    def get_api_key(self):
-        """Retrieve the next API key from the list."""
-        if self.current_key_index < len(self.api_keys):
-            return self.api_keys[self.current_key_index]
+
+    def get_url_template(self):
+        """Builds the %-style request URL template for the selected mode once, so only the request values vary per call."""
+        if self.mode == FORECAST:
+            query = f'?tz=local&lat=%(lat)s&lon=%(lon)s&key=%(key)s&hours={self.forecast_hours}'
+        else:
+            query = '?tz=local&lat=%(lat)s&lon=%(lon)s&start_date=%(start_date)s&end_date=%(end_date)s&key=%(key)s'
+        return f'{self.base_url}{MODES[self.mode]["URL"]}'.replace('%', '%%') + query
+
+    def get_api_key(self, partition):
+        """Retrieve the partition's next API key that is not cooling down after a rate limit, or None if all are."""
+        now = time.time()
+        for offset in range(len(partition.api_keys)):
+            index = (partition.key_cursor + offset) % len(partition.api_keys)
+            if self.key_cooldowns.get(partition.api_keys[index], 0) <= now:
+                partition.key_cursor = index
+                return partition.api_keys[index]
         return None
 
-    def mine_location(self, location):
-        """Mines historic weather data for a single location and saves it to a CSV file."""
-        lat = location['lat']
-        lon = location['lon']
-        location_name = location['name']
-        filename = f'{location_name}_weather_data_{self.mode}.csv'
+    async def mine_location(self, location, partition):
+        """Mines historic weather data for a single location with its partition's API keys and saves it to a CSV file."""
+        lat = location.lat
+        lon = location.lon
+        location_name = location.name
 
-        start_date_str = self.date_tracking.get(location_name, self.oldest_date.strftime('%Y-%m-%d'))
-        start_date = datetime.strptime(start_date_str, '%Y-%m-%d')
+        start_date_str = self.date_tracking.get(location_name, self.oldest_date_str)
+        start_date = datetime.fromisoformat(start_date_str)
         end_date = datetime.utcnow()
-        all_data = []
-            
+        rows_since_checkpoint = 0
+        written_through = None
+
+        filename = f'{location_name}_weather_data_{self.mode}.csv'
+        if self.compress_output:
+            # Every run gets its own segment, so a run killed mid-frame cannot corrupt earlier ones
+            filename = f'{location_name}_weather_data_{self.mode}_{end_date.strftime("%Y%m%dT%H%M%S%f")}.csv.zst'
+
+        windows = []
         while start_date < end_date:
             current_end_date = min(start_date + timedelta(days=self.days_per_request), end_date)
-            data = self.get_weather_data_with_retry(lat, lon, start_date.strftime('%Y-%m-%d'), current_end_date.strftime('%Y-%m-%d'))
-            if data is None:
-                if len(all_data) == 0:
-                    logging.warning(f'Failed to fetch data after {self.max_retries} retries. No data collected for {location}')
-                    raise
-                logging.warning(f'Failed to fetch data after {self.max_retries} retries. Saving collected data and terminating.')
-                self.save_to_csv(all_data, filename)
-                if self.mode != FORECAST:
-                    self.date_tracking[location_name] = start_date.strftime('%Y-%m-%d')
-                    self.save_date_tracking(self.date_tracking)
-                break
-            all_data.extend(data)
-            if (current_end_date - self.oldest_date).days >= self.save_checkpoint_months*30 or current_end_date == end_date:
-                self.save_to_csv(all_data, filename)
-                all_data = []
-                if self.mode != FORECAST:
-                    self.date_tracking[location_name] = current_end_date.strftime('%Y-%m-%d')
-                    self.save_date_tracking(self.date_tracking)
+            windows.append((start_date, current_end_date))
             start_date = current_end_date
-        if len(all_data):
-            logging.info(f'Data saved to {filename} from {start_date} to {end_date}')
 
-    def get_weather_data_with_retry(self, lat, lon, start_date, end_date):
+        # Keep a bounded number of windows in flight so requests overlap without holding every response in memory
+        lookahead = len(partition.api_keys) * self.requests_per_key
+        windows = iter(windows)
+        fetches = deque()
+        self.schedule_fetches(fetches, windows, lookahead, lat, lon, partition)
+        filepath = f'{OUTPUT_DATA_FOLDER}/{filename}'
+        writer = None
+        # Keep the output file open for the whole location instead of reopening it per checkpoint.
+        # A large buffer lets the OS batch writes; it is only flushed explicitly at checkpoints.
+        output_file = self.open_output_file(filepath)
+        try:
+            with output_file as file:
+                # If the file is empty, the header still needs to be written
+                write_header = os.path.getsize(filepath) == 0
+                try:
+                    while fetches:
+                        # Drop the task once consumed so its response is not kept alive
+                        (start_date, current_end_date), fetch = fetches.popleft()
+                        data = await fetch
+                        fetch = None
+                        self.schedule_fetches(fetches, windows, 1, lat, lon, partition)
+                        if data is None:
+                            if writer is None:
+                                logging.warning(f'Failed to fetch data after {self.max_retries} retries. No data collected for {location}')
+                                raise
+                            logging.warning(f'Failed to fetch data after {self.max_retries} retries. Saving collected data and terminating.')
+                            file.flush()
+                            if self.mode != FORECAST:
+                                self.date_tracking[location_name] = start_date.date().isoformat()
+                                self.save_date_tracking(self.date_tracking)
+                            break
+                        # Stream each response straight to the file instead of accumulating it
+                        writer = self.save_to_csv(data, file, writer, write_header)
+                        rows_since_checkpoint += len(data)
+                        written_through = current_end_date
+                        if rows_since_checkpoint >= self.max_buffered_rows or (current_end_date - self.oldest_date).days >= self.save_checkpoint_months*30 or current_end_date == end_date:
+                            rows_since_checkpoint = 0
+                            # Rows must reach the file before the tracker moves past them
+                            file.flush()
+                            if self.mode != FORECAST:
+                                self.date_tracking[location_name] = current_end_date.date().isoformat()
+                                self.save_date_tracking(self.date_tracking)
+                except BaseException:
+                    # Rows written since the last checkpoint reach the file on close, so the tracker
+                    # must cover them too or the next run would fetch and append them again.
+                    # This includes cancellation (e.g. Ctrl-C), which is not an Exception.
+                    if written_through is not None and self.mode != FORECAST:
+                        file.flush()
+                        self.date_tracking[location_name] = written_through.date().isoformat()
+                        self.save_date_tracking(self.date_tracking)
+                    raise
+                finally:
+                    # Windows past a failure are no longer needed
+                    for _, fetch in fetches:
+                        fetch.cancel()
+                    await asyncio.gather(*[fetch for _, fetch in fetches], return_exceptions=True)
+        finally:
+            # A run that wrote nothing must not leave an empty file, or a headerless compressed segment, behind
+            if writer is None and (self.compress_output or os.path.getsize(filepath) == 0):
+                os.remove(filepath)
+        if writer is not None:
+            logging.info(f'Data saved to {filename} from {start_date_str} to {end_date}')
+
+    def schedule_fetches(self, fetches, windows, count, lat, lon, partition):
+        """Starts fetching up to count more windows, queueing each task behind its (start, end) window."""
+        for window_start, window_end in itertools.islice(windows, count):
+            fetch = asyncio.ensure_future(self.get_weather_data_with_retry(lat, lon, window_start.date().isoformat(), window_end.date().isoformat(), partition))
+            fetches.append(((window_start, window_end), fetch))
+
+    async def get_weather_data_with_retry(self, lat, lon, start_date, end_date, partition):
         """Makes an API call to retrieve weather data with rate limiting and retries."""
         attempt = 0
+        rate_limited_keys = set()
         while attempt < self.max_retries:
-            self.api_key = self.get_api_key()
-            if not self.api_key:
-                logging.error('All API keys have been rate limited. Stopping application.')
-                raise Exception('All API keys rate limited')  # Or use a more specific exception
+            api_key = self.get_api_key(partition)
+            if not api_key or len(rate_limited_keys) == len(partition.api_keys):
+                # Every key has been rate limited, so only now wait before another full rotation
+                attempt += 1
+                if attempt >= self.max_retries:
+                    logging.error('All API keys have been rate limited. Stopping application.')
+                    raise Exception('All API keys rate limited')  # Or use a more specific exception
+                earliest_cooldown = min(self.key_cooldowns[key] for key in partition.api_keys if key in self.key_cooldowns)
+                cooldown_remaining = earliest_cooldown - time.time()
+                if cooldown_remaining > self.max_retry_delay_seconds:
+                    # A quota reset hours away is not worth waiting on, so give up instead of sleeping
+                    logging.error(f'All API keys are rate limited for another {cooldown_remaining:.0f}s. Stopping application.')
+                    raise Exception(f'All API keys rate limited for longer than MAX_RETRY_DELAY_SECONDS ({self.max_retry_delay_seconds}s)')
+                await asyncio.sleep(max(self.get_backoff_delay(attempt - 1), cooldown_remaining))
+                rate_limited_keys.clear()
+                continue
             try:
-                if self.mode == FORECAST:
-                    url = f'{self.base_url}{MODES[self.mode]["URL"]}?tz=local&lat={lat}&lon={lon}&key={self.api_key}&hours={self.forecast_hours}'
-                else:
-                    url = f'{self.base_url}{MODES[self.mode]["URL"]}?tz=local&lat={lat}&lon={lon}&start_date={start_date}&end_date={end_date}&key={self.api_key}'
-                response = requests.get(url)
-                response.raise_for_status()  # This will raise an exception for HTTP errors
-                return response.json()['data']
-            except requests.exceptions.HTTPError as e:
+                url = self.url_template % {'lat': lat, 'lon': lon, 'start_date': start_date, 'end_date': end_date, 'key': api_key}
+                if self.mode != FORECAST:
+                    return await self.fetch_weather_data(url, partition)
+                # Forecasts only vary by location, so concurrent windows wait on a single fetch and reuse it while fresh
+                cache_key = self._cache_key(url)
+                async with self.cache_locks.setdefault(cache_key, asyncio.Lock()):
+                    cached = self.response_cache.get(cache_key)
+                    if cached and time.time() - cached[0] < self.forecast_cache_ttl_seconds:
+                        return cached[1]
+                    data = await self.fetch_weather_data(url, partition)
+                    self.response_cache[cache_key] = (time.time(), data)
+                    return data
+            except httpx.HTTPStatusError as e:
                 if e.response.status_code == 429:
-                    logging.warning(f'Rate limit exceeded for API key {self.api_key}. (attempt {attempt + 1})')
-                    # Move to the next API key
-                    if self.current_key_index >= len(self.api_keys):
-                        # If all keys are exhausted, stop the application
-                        logging.error('All API keys have been rate limited. Stopping application.')
-                        raise
-                    if attempt < self.max_retries - 1:
-                        time.sleep(self.retry_delay_seconds)
-                        attempt += 1
-                    else:
-                        self.current_key_index += 1
-                        attempt = 0
+                    logging.warning(f'Rate limit exceeded for API key {api_key}. (attempt {attempt + 1})')
+                    # Park the key, for as long as the API asks if it says, and move straight on to the next one
+                    retry_after = e.response.headers.get('Retry-After', '')
+                    cooldown_seconds = int(retry_after) if retry_after.isdigit() else self.key_cooldown_seconds
+                    self.key_cooldowns[api_key] = time.time() + cooldown_seconds
+                    rate_limited_keys.add(api_key)
+                    if api_key == partition.api_keys[partition.key_cursor]:
+                        partition.key_cursor = (partition.key_cursor + 1) % len(partition.api_keys)
                 else:
                     logging.warning(f'HTTPError for URL {url}: {e}')
                     raise
-            except requests.exceptions.RequestException as e:
+            except httpx.RequestError as e:
                 if attempt < self.max_retries - 1:
-                    time.sleep(self.retry_delay_seconds)
+                    await asyncio.sleep(self.get_backoff_delay(attempt))
+                    attempt += 1
                 else:
                     logging.error(f'RequestException for URL {url}: {e}')
                     raise
 
-    def save_to_csv(self, data, filename):
-        """Saves the data to a CSV file, flattening nested objects."""
+    async def fetch_weather_data(self, url, partition):
+        """Sends a single API request within the partition's request limit and returns its data."""
+        async with partition.request_semaphore:
+            response = await self.client.get(url)
+        response.raise_for_status()  # This will raise an exception for HTTP errors
+        return orjson.loads(response.content)['data']
+
+    def get_backoff_delay(self, attempt):
+        """Returns an exponentially growing retry delay with jitter, so concurrent requests do not retry in lockstep."""
+        return min(self.max_retry_delay_seconds, self.retry_delay_seconds * 2 ** attempt) + random.random()
+
+    def _cache_key(self, url):
+        """Strips the API key from a URL so responses are cached independently of the key used."""
+        return re.sub(r'&key=[^&]*', '', url)
+
+    def open_output_file(self, filepath):
+        """Opens a CSV output file for appending, or a new zstd-compressed segment when output compression is enabled."""
+        if not self.compress_output:
+            return open(filepath, mode='a', newline='', buffering=CSV_WRITE_BUFFER_SIZE)
+        # Compressed segments are only ever written by the run that created them
+        compressor = zstandard.ZstdCompressor(level=ZSTD_COMPRESSION_LEVEL)
+        return io.TextIOWrapper(compressor.stream_writer(open(filepath, mode='xb', buffering=CSV_WRITE_BUFFER_SIZE)), newline='')
+
+    def save_to_csv(self, data, file, writer=None, write_header=False):
+        """Appends the data to an open CSV file, flattening nested objects, and returns the writer for reuse."""
         if not data:
-            return
-        filepath = f'{OUTPUT_DATA_FOLDER}/{filename}'
-        # Prepare the CSV file for writing
-        with open(filepath, mode='a', newline='') as file:
-            # If the file is empty, write the header
-            if file.tell() == 0:
-                # Extract fieldnames from the first data entry
-                # This includes nested fields like 'weather.icon'
-                fieldnames = self.get_fieldnames(data[0])
-                writer = csv.DictWriter(file, fieldnames=fieldnames)
-                writer.writeheader()
-            else:
-                # No need to write the header
-                writer = csv.DictWriter(file, fieldnames=self.get_fieldnames(data[0]))
+            return writer
+        schema = self.get_schema(data[0])
+        if writer is None:
+            writer = csv.writer(file)
+            if write_header:
+                writer.writerow([field for field, _ in schema])
 
-            # Write the data rows, flattening each entry
-            for entry in data:
-                flat_entry = self.flatten_data(entry)
-                writer.writerow(flat_entry)
+        # Write the data rows in one batch, flattening each entry as it is consumed
+        writer.writerows(self.flatten_data(entry, schema) for entry in data)
+        return writer
 
-    def get_fieldnames(self, data_entry):
-        """Recursively extracts field names from a nested data entry."""
-        fieldnames = []
-        for key, value in data_entry.items():
-            # If the value is a dictionary, recurse
-            if isinstance(value, dict):
-                sub_fieldnames = self.get_fieldnames(value)
-                # Prefix the nested keys with the current key
-                fieldnames.extend([f"{key}.{sub_key}" for sub_key in sub_fieldnames])
-            else:
-                fieldnames.append(key)
-        return fieldnames
+    def get_schema(self, data_entry):
+        """Returns the flattening schema for the current mode, compiling it from the first entry seen."""
+        # The schema is fixed per mode, so it only needs to be walked once
+        if self.mode not in self.schema_cache:
+            self.schema_cache[self.mode] = self.compile_schema(data_entry)
+        return self.schema_cache[self.mode]
 
-    def flatten_data(self, data_entry):
-        """Flattens a nested data entry into a single dictionary with dot-separated keys."""
-        flat_data = {}
+    def compile_schema(self, data_entry, prefix=()):
+        """Recursively compiles a nested data entry into (field name, key path) pairs."""
+        schema = []
         for key, value in data_entry.items():
+            path = prefix + (key,)
             # If the value is a dictionary, recurse
             if isinstance(value, dict):
-                sub_flat_data = self.flatten_data(value)
-                # Prefix the nested keys with the current key
-                for sub_key, sub_value in sub_flat_data.items():
-                    flat_data[f"{key}.{sub_key}"] = sub_value
+                schema.extend(self.compile_schema(value, path))
             else:
-                flat_data[key] = value
-        return flat_data
+                # Nested fields are named with dot-separated keys, like 'weather.icon'
+                schema.append(('.'.join(path), path))
+        return schema
+
+    def flatten_data(self, data_entry, schema):
+        """Flattens a nested data entry into a row tuple ordered like the schema's field names."""
+        return tuple([self.walk_path(data_entry, path) for _, path in schema])
+
+    @staticmethod
+    def walk_path(data_entry, path):
+        """Follows a key path into a nested data entry, returning None if any key is missing."""
+        value = data_entry
+        try:
+            for key in path:
+                value = value[key]
+        except (KeyError, TypeError):
+            return None
+        return value
 
     def load_date_tracking(self):
         """Loads the date tracking from a JSON file."""
         if os.path.exists(MODES[self.mode]['TRACKER']):
-            with open(MODES[self.mode]['TRACKER'], 'r') as file:
-                return json.load(file)
+            with open(MODES[self.mode]['TRACKER'], 'rb') as file:
+                return orjson.loads(file.read())
         else:
             return {}
 
     def save_date_tracking(self, date_tracking):
-        """Saves the date tracking to a JSON file."""
-        with open(MODES[self.mode]['TRACKER'], 'w') as file:
-            json.dump(date_tracking, file)
+        """Saves the date tracking to a JSON file, atomically replacing the previous one."""
+        # Nothing to do if no location has advanced since the last save
+        if date_tracking == self.last_saved_tracking:
+            return
+        tracker_path = MODES[self.mode]['TRACKER']
+        temp_path = f'{tracker_path}.tmp'
+        # Write to a temporary file first so a crash mid-write never leaves a truncated tracker
+        with open(temp_path, 'wb') as file:
+            file.write(orjson.dumps(date_tracking))
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temp_path, tracker_path)
+        self.last_saved_tracking = dict(date_tracking)